@@ -8,51 +8,72 @@ import dash
 import dash_table
 import dash_core_components as dcc
 import dash_html_components as html
-import plotly.express as px
 import pandas as pd
 import numpy as np
 from dash import Output, Input
 from statsmodels.tsa.stattools import pacf
 import plotly.graph_objects as go 
-import datetime
 from datetime import date
-from statsmodels.tsa.arima.model import ARIMA
-from collections import OrderedDict
+from statsforecast.models import ARIMA as SFARIMA
+from functools import lru_cache
+from dataclasses import dataclass
+from flask_caching import Cache
+from numba import njit
 
 app = dash.Dash(__name__)
 server = app.server
+cache = Cache(server, config={
+    'CACHE_TYPE': 'SimpleCache',
+    'CACHE_DEFAULT_TIMEOUT': 3600
+})
 colors = {
     'background': '#111111',
     'text': '#7FDBFF'
 }
 
 ##
-def load_ferry(path,route_number):
+DATA_PATH = 'Transit_Ferry_Passenger_Counts.csv'
+
+# read and parse the ferry data once at import, then split it by route
+RAW = pd.read_csv(DATA_PATH, parse_dates=['Route_Date'])
+RAW = RAW.set_index('Route_Date').sort_index()
+# route and week labels repeat across rows, so filter and group on integer codes
+RAW['Route_Number'] = RAW['Route_Number'].astype('category')
+RAW['Week_Range'] = RAW['Week_Range'].astype('category')
+
+ROUTES = {}
+for r, g in RAW.groupby('Route_Number', observed=True):
+    g = g.copy()
+    # impute missing value using pad method; counts are small, float32 is plenty
+    g['Ridership_Total'] = g['Ridership_Total'].ffill().astype('float32')
+    ROUTES[r] = g
+
+# weekly average ridership per route, with the first/last day of each week
+# so a date window can be mapped onto whole weeks without regrouping
+WEEKLY = {}
+WEEK_SPANS = {}
+for r, g in ROUTES.items():
+    weeks = g.reset_index().groupby('Week_Range', sort=False, observed=True).agg(
+        Ridership_Total=('Ridership_Total', 'mean'),
+        Week_Start=('Route_Date', 'min'),
+        Week_End=('Route_Date', 'max')
+    ).sort_values('Week_Start')
+    # kept apart so slicing the weekly means is a view, not a column copy
+    WEEKLY[r] = weeks[['Ridership_Total']]
+    WEEK_SPANS[r] = weeks[['Week_Start', 'Week_End']]
+
+def load_ferry(route_number):
     '''
     Input:
-    path: Ferry Data file path;
     route_number: Route Number from one place to another. E.g. FerryDH means ferry from Dartmouth to Halifax
     
     Output:
-    a dataframe
+    a dataframe (shared across callbacks, do not modify in place)
     
     '''
-    ferry = pd.read_csv(path)
-    # transform to date format
-    ferry['Route_Date'] = pd.to_datetime(ferry['Route_Date'])
-    
-    # select a specific route for future analysis
-    Ferry=ferry[ferry['Route_Number'] == route_number]
-    Ferry.index = Ferry['Route_Date']
-    Ferry = Ferry.sort_index()
-    Ferry = Ferry.drop('Route_Date',axis = 1)
-    
-    # impute missing value using pad method
-    Ferry['Ridership_Total']=Ferry['Ridership_Total'].fillna(method='ffill')
-    
-    return Ferry
+    return ROUTES[route_number]
 
-def get_ferry_data(Ferry,time_window):
+def get_ferry_data(Ferry,route_number,time_window):
     '''
     Inputs:
     Ferry: dataframe from load_ferry function
@@ -63,12 +84,29 @@ def get_ferry_data(Ferry,time_window):
     Three plots and two dataframes (One is daily ridership, one is weekly average ridership)
     '''
     
-    Ferry_slice = Ferry[np.logical_and(time_window[0] < Ferry.index, Ferry.index < time_window[1])]
+    # the index is sorted, so binary search for the open interval (start, end)
+    start = pd.Timestamp(time_window[0], tz=Ferry.index.tz)
+    end = pd.Timestamp(time_window[1], tz=Ferry.index.tz)
+    lo = Ferry.index.searchsorted(start, side='right')
+    hi = Ferry.index.searchsorted(end, side='left')
+    Ferry_slice = Ferry.iloc[lo:hi]
     # Ferry_slice['Ridership_Total'].plot(figsize=(20,10),fontsize=20)
     # plt.title('Ferry Ridership of '+ route_number +' Per Day'+' from ' + time_window[0] +' to '+time_window[1], fontsize=20)
     # plt.show()
     
-    Ferry_slice_week=pd.DataFrame(Ferry_slice.groupby(['Week_Range'])['Ridership_Total'].mean())
+    # weeks lying wholly inside the time window use the precomputed means; the
+    # (at most two) weeks cut by the window edges are averaged over the selected days
+    Spans = WEEK_SPANS[route_number]
+    inner_lo = Spans['Week_Start'].searchsorted(start, side='right')
+    inner_hi = max(inner_lo, Spans['Week_End'].searchsorted(end, side='left'))
+    if inner_hi > inner_lo:
+        head = Ferry_slice.index.searchsorted(Spans['Week_Start'].iloc[inner_lo], side='left')
+        tail = Ferry_slice.index.searchsorted(Spans['Week_End'].iloc[inner_hi-1], side='right')
+        Edge = pd.concat([Ferry_slice.iloc[:head], Ferry_slice.iloc[tail:]])
+    else:
+        Edge = Ferry_slice
+    Edge_week = Edge.groupby('Week_Range', observed=True)[['Ridership_Total']].mean()
+    Ferry_slice_week = pd.concat([WEEKLY[route_number].iloc[inner_lo:inner_hi], Edge_week]).sort_index()
     # Ferry_slice_week['Ridership_Total'].plot(figsize=(20,10),fontsize=10)
     # plt.title('Ferry Ridership (on a weekly basis)',fontsize=20)
     # plt.show()
@@ -82,22 +120,108 @@ def get_ferry_data(Ferry,time_window):
     
     return Ferry_slice, Ferry_slice_week
 
-def model_predict(Ferry, steps):
+# an (8, 0, 3) model has 12 parameters; shorter windows give NaN residuals
+# or forecasts that blow up
+MIN_TRAINING_DAYS = 28
+
+class WindowTooShortError(ValueError):
+    '''
+    Raised when the selected date range has too few days to fit the forecasting model.
+    '''
+
+@dataclass(frozen=True)
+class ArimaState:
+    '''
+    The parts of a fitted ARIMA kept after fitting: AR/MA coefficients,
+    intercept, the final Kalman state the forecast starts from, and the
+    noise variance.
+    '''
+    __slots__ = ('ar', 'ma', 'mean', 'state', 'sigma2')
+    ar: np.ndarray
+    ma: np.ndarray
+    mean: float
+    state: np.ndarray
+    sigma2: float
+
+@lru_cache(maxsize=64)
+def _fit_arima(route_number, start_date, end_date):
+    '''
+    Inputs:
+    route_number: Route Number from one place to another. E.g. FerryDH means ferry from Dartmouth to Halifax
+    start_date, end_date: ISO date strings bounding the training window. E.g. '2021-03-01'
+    
+    Outputs:
+    an ArimaState for the fitted model, cached so that changing only the forecast horizon does not refit
+    raises WindowTooShortError if the window has fewer than MIN_TRAINING_DAYS days
+    '''
+    Ferry = load_ferry(route_number)
+    Ferry_slice, _ = get_ferry_data(Ferry, route_number, time_window = [start_date,end_date])
+    X = Ferry_slice['Ridership_Total'].values
+    if len(X) < MIN_TRAINING_DAYS:
+        raise WindowTooShortError('Select at least %d days of data to forecast ridership' % MIN_TRAINING_DAYS)
+    model = SFARIMA(order=(8, 0, 3))
+    model.fit(y=X.astype(np.float64))
+    
+    # keep only what the forecast needs and let the full fit be collected
+    fit = model.model_
+    return ArimaState(
+        ar=np.array(fit['model']['phi'], dtype=np.float64),
+        ma=np.array(fit['model']['theta'], dtype=np.float64),
+        mean=float(fit['coef'].get('intercept', 0.0)),
+        state=np.array(fit['model']['a'], dtype=np.float64),
+        sigma2=float(fit['sigma2'])
+    )
+
+@njit(cache=True, fastmath=True)
+def _forecast(phi, a, mean, steps):
     '''
     Inputs:
-    Ferry: Ferry dataframe
-    Steps: how many days/weeks want to forecast (days or weeks depend on your Ferry dataframe based on which measure)
+    phi: fitted AR coefficients
+    a: final Kalman state of the fitted model, of length max(p, q+1)
+    mean: fitted intercept of the series
+    steps: how many days want to forecast
+    
+    Outputs:
+    point forecasts, i.e. the first state element after each transition step
+    '''
+    p = phi.shape[0]
+    r = a.shape[0]
+    state = a.copy()
+    out = np.empty(steps)
+    for h in range(steps):
+        # state = T @ state, with T = [phi | shifted identity]
+        first = state[0]
+        for i in range(r):
+            v = phi[i] * first if i < p else 0.0
+            if i + 1 < r:
+                v += state[i + 1]
+            state[i] = v
+        out[h] = state[0] + mean
+    return out
+
+def model_predict(route_number, start_date, end_date, steps):
+    '''
+    Inputs:
+    route_number: Route Number from one place to another. E.g. FerryDH means ferry from Dartmouth to Halifax
+    start_date, end_date: ISO date strings bounding the training window. E.g. '2021-03-01'
+    Steps: how many days want to forecast
     
     Outputs:
     predictions for future ferry
     '''
-    X = Ferry['Ridership_Total'].values
-    history = [x for x in X]
-    model = ARIMA(history, order=(8, 0, 3))
-    model_fit = model.fit()
-    output = model_fit.forecast(steps=steps)
+    fit = _fit_arima(route_number, start_date, end_date)
+    output = _forecast(fit.ar, fit.state, fit.mean, steps)
     return np.round(output,0)
 
+# date range the picker opens with
+DEFAULT_START_DATE = date(2021, 3, 1)
+DEFAULT_END_DATE = date(2021, 10, 29)
+
+# fit every route on the default range at startup (this also compiles the
+# forecast kernel), so the first page load only slices and forecasts
+for r in ROUTES:
+    model_predict(r, DEFAULT_START_DATE.isoformat(), DEFAULT_END_DATE.isoformat(), steps = 1)
+
 # see https://plotly.com/python/px-arguments/ for more options
 app.title = 'Halifax Ferry Ridership Analytics'
 app.layout = html.Div(
@@ -166,8 +290,8 @@ app.layout = html.Div(
         min_date_allowed=date(2017, 1, 1),
         max_date_allowed=date(2021, 10, 29),
         initial_visible_month=date(2017, 1, 1),
-        start_date = date(2021,3,1),
-        end_date=date(2021, 10, 29)
+        start_date = DEFAULT_START_DATE,
+        end_date=DEFAULT_END_DATE
     ),
 
     dcc.Graph(
@@ -207,7 +331,32 @@ app.layout = html.Div(
 
         html.Br(),
 
-        html.Table(id = 'prediction-table',
+        html.P(id = 'prediction-message',
+        style={
+            'textAlign': 'center',
+            'margin':'auto',
+            'font-family':'Arial'
+        }),
+
+        html.Table(
+            dash_table.DataTable(
+                id='prediction-table-data',
+                columns=[{'id': c, 'name': c} for c in ['Date', 'Predicted Ridership']],
+                page_action='none',
+                style_table={'height': '200px', 'overflowY': 'auto'},
+                style_header={
+                    'textAlign':'center',
+                    # 'backgroundColor': 'rgb(30, 30, 30)',
+                    # 'color': 'white'
+                },
+                style_data={
+                    'textAlign':'center',
+                    'width':'500px',
+                    # 'backgroundColor': 'rgb(50, 50, 50)',
+                    # 'color': 'white'
+                },
+            ),
+        id = 'prediction-table',
         style={
             'textAlign': 'center',
             'margin':'auto',
@@ -220,30 +369,21 @@ app.layout = html.Div(
         'padding':'0',
         'background-color': '#F7F7F7'
 })
-@app.callback(
-    Output('daily-ridership-graph', 'figure'),
-    Output('weekly-average-ridership-graph', 'figure'),
-    Output('prediction-table','children'),
-    Input('demo-dropdown', 'value'),
-    Input('my-date-picker-range', 'start_date'),
-    Input('my-date-picker-range', 'end_date'),
-    Input('my-input-steps', 'value')
-
-)
-
-def update_output(route_value,start_date,end_date,steps_value):
-    Ferry = load_ferry(path = 'Transit_Ferry_Passenger_Counts.csv',route_number = route_value)
-    Ferry_slice, Ferry_slice_week = get_ferry_data(Ferry, time_window = [start_date,end_date])
-    fig1 = px.line(Ferry_slice, x=Ferry_slice.index, y=Ferry_slice['Ridership_Total'], title = 'Daily Ridership Trend',
-                        labels={
-                            'Route_Date':'',
-                            'Ridership_Total':''
-                        })
-    fig2 = px.line(Ferry_slice_week, x=Ferry_slice_week.index, y=Ferry_slice_week['Ridership_Total'],title='Weekly Average Ridership Trend',
-                        labels={
-                                'Week_Range':'',
-                                'Ridership_Total':''
-                            })
+@cache.memoize()
+def build_figures(route_value,start_date,end_date):
+    '''
+    Inputs:
+    the route and date range selected on the dashboard
+    
+    Outputs:
+    the daily and weekly trend figures as dicts, memoized server-side
+    '''
+    Ferry = load_ferry(route_number = route_value)
+    Ferry_slice, Ferry_slice_week = get_ferry_data(Ferry, route_number = route_value, time_window = [start_date,end_date])
+    fig1 = go.Figure(go.Scattergl(x=Ferry_slice.index.values, y=Ferry_slice['Ridership_Total'].values, mode='lines'))
+    fig1.update_layout(title='Daily Ridership Trend')
+    fig2 = go.Figure(go.Scattergl(x=Ferry_slice_week.index.astype(str).values, y=Ferry_slice_week['Ridership_Total'].values, mode='lines'))
+    fig2.update_layout(title='Weekly Average Ridership Trend')
     fig2.update_xaxes(showticklabels=False)
     #ACF Plot
     # fig3 = go.Figure()
@@ -253,35 +393,53 @@ def update_output(route_value,start_date,end_date,steps_value):
     # ))
  
     # pd.plotting.autocorrelation_plot(Ferry_slice_week['Ridership_Total'])
-    future_preds=model_predict(Ferry_slice, steps = steps_value)
-    end_date_datetime = date(int(end_date.split('-')[0]),int(end_date.split('-')[1]),int(end_date.split('-')[2]))
-    data = OrderedDict(
-    [
-        ("Date", [str(end_date_datetime + datetime.timedelta(days=i+1)) for i in range(steps_value)]),
-        ("Predicted Ridership", future_preds)
-    ]
-)
-    df = pd.DataFrame(
-    OrderedDict([(name, col_data) for (name, col_data) in data.items()])
+    return fig1.to_dict(),fig2.to_dict()
+
+@cache.memoize()
+def build_predictions(route_value,start_date,end_date,steps_value):
+    '''
+    Inputs:
+    the route and date range selected on the dashboard, and the forecast steps
+    
+    Outputs:
+    the prediction table records and a message shown above the table
+    (empty unless the inputs cannot be forecast), memoized server-side
+    '''
+    if not isinstance(steps_value, int) or steps_value < 1:
+        return [], 'Enter a whole number of days (1 or more) to forecast'
+    try:
+        future_preds=model_predict(route_value, start_date, end_date, steps = steps_value)
+    except WindowTooShortError as e:
+        return [], str(e)
+    # the day after end_date onwards
+    dates = pd.date_range(date.fromisoformat(end_date), periods=steps_value+1, freq='D')[1:].strftime('%Y-%m-%d').tolist()
+    records = [{'Date': d, 'Predicted Ridership': float(p)} for d, p in zip(dates, future_preds)]
+    return records, ''
+
+@app.callback(
+    Output('daily-ridership-graph', 'figure'),
+    Output('weekly-average-ridership-graph', 'figure'),
+    Input('demo-dropdown', 'value'),
+    Input('my-date-picker-range', 'start_date'),
+    Input('my-date-picker-range', 'end_date')
+
 )
-    table = dash_table.DataTable(
-    data=df.to_dict('records'),
-    columns=[{'id': c, 'name': c} for c in df.columns],
-    page_action='none',
-    style_table={'height': '200px', 'overflowY': 'auto'},
-     style_header={
-        'textAlign':'center',
-        # 'backgroundColor': 'rgb(30, 30, 30)',
-        # 'color': 'white'
-    },
-    style_data={
-        'textAlign':'center',
-        'width':'500px',
-        # 'backgroundColor': 'rgb(50, 50, 50)',
-        # 'color': 'white'
-    },
+
+def update_graphs(route_value,start_date,end_date):
+    return build_figures(route_value,start_date,end_date)
+
+@app.callback(
+    Output('prediction-table-data','data'),
+    Output('prediction-message','children'),
+    Input('demo-dropdown', 'value'),
+    Input('my-date-picker-range', 'start_date'),
+    Input('my-date-picker-range', 'end_date'),
+    Input('my-input-steps', 'value')
+
 )
-    return fig1,fig2,table
+
+def update_table(route_value,start_date,end_date,steps_value):
+    return build_predictions(route_value,start_date,end_date,steps_value)
 
 if __name__ == '__main__':
     app.run_server(port=1111,debug=True)
\ No newline at end of file